@@ -1,18 +1,23 @@
 from __future__ import annotations
 
+import functools
 import io
 import json
 import os
 import random
-import string
+import secrets
 import math
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Tuple
 
 from firebase_functions import https_fn
 import firebase_admin
+from google.api_core import exceptions as gcs_exc
 from google.cloud import storage
-from PIL import Image, ImageOps
+import numpy as np
+from PIL import Image
+from requests.adapters import HTTPAdapter
 
 
 # ----------------------------------------------------------------------
@@ -23,15 +28,15 @@ from PIL import Image, ImageOps
 if not firebase_admin._apps:
     firebase_admin.initialize_app()
 
-# Lazy-init Google Cloud Storage client
-_storage_client: storage.Client | None = None
+# Build the storage client at import time so its setup cost lands in
+# container init rather than the first request
+_storage_client = storage.Client()
 
-
-def get_storage_client() -> storage.Client:
-    global _storage_client
-    if _storage_client is None:
-        _storage_client = storage.Client()
-    return _storage_client
+# Default requests pool keeps only 10 connections per host; size it for the
+# concurrent blob downloads so each worker reuses its own keep-alive socket
+_storage_client._http.mount(
+    "https://", HTTPAdapter(pool_connections=32, pool_maxsize=32)
+)
 
 
 # ----------------------------------------------------------------------
@@ -42,10 +47,21 @@ def get_storage_client() -> storage.Client:
 STAMP_BUCKET = os.environ.get("STAMP_BUCKET")  # e.g. triparific100.appspot.com
 STAMPS_PREFIX = os.environ.get("STAMPS_PREFIX", "passportStamps")
 
+# Fail at import rather than on each request; every function needs the bucket
+if not STAMP_BUCKET:
+    raise RuntimeError("STAMP_BUCKET env var not set")
+_BUCKET = _storage_client.bucket(STAMP_BUCKET)
+
 # Flags (t-shirt flag grid)
 FLAGS_PREFIX = os.environ.get("FLAGS_PREFIX", "flags/png1000px")
+# Smaller renditions, used when they are wide enough for the requested tile
+FLAGS_PREFIX_SMALL = os.environ.get("FLAGS_PREFIX_SMALL", "flags/png256px")
+FLAGS_SMALL_WIDTH = int(os.environ.get("FLAGS_SMALL_WIDTH", "256"))
 FLAGS_OUTPUT_PREFIX = os.environ.get("FLAGS_OUTPUT_PREFIX", "tshirt/flags")
 
+# Output encoding: "png" (fast zlib level 1) or "webp"
+OUTPUT_FORMAT = os.environ.get("OUTPUT_FORMAT", "png").lower()
+
 # Shared image layout config
 CANVAS_WIDTH = 2000
 CANVAS_HEIGHT = 2000
@@ -55,11 +71,17 @@ MAX_ROTATION_DEG = 25
 AVOID_OVERLAP = True
 OVERLAP_RETRIES = 15
 
+# GCS downloads are network-bound, so fetch blobs concurrently
+DOWNLOAD_WORKERS = 16
 
-def _require_bucket() -> str:
-    if not STAMP_BUCKET:
-        raise RuntimeError("STAMP_BUCKET env var not set")
-    return STAMP_BUCKET
+# Raw blob bytes kept in memory across warm invocations
+BLOB_CACHE_SIZE = 256
+
+_rng = np.random.default_rng()
+
+# Small flag renditions that 404'd. Misses aren't lru_cached, so without this a
+# missing FLAGS_PREFIX_SMALL copy would cost an extra GET on every request
+_small_flag_misses = set()
 
 
 # ----------------------------------------------------------------------
@@ -81,8 +103,24 @@ def hello(req: https_fn.Request) -> https_fn.Response:
 
 def _random_filename(prefix: str = "image") -> str:
     ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
-    rand = "".join(random.choices(string.ascii_lowercase + string.digits, k=6))
-    return f"{prefix}_{ts}_{rand}.png"
+    rand = secrets.token_hex(3)
+    ext = "webp" if OUTPUT_FORMAT == "webp" else "png"
+    return f"{prefix}_{ts}_{rand}.{ext}"
+
+
+@functools.lru_cache(maxsize=BLOB_CACHE_SIZE)
+def _fetch_blob_bytes_cached(blob_path: str) -> bytes:
+    # No blob.exists() pre-check: a missing blob 404s on the GET itself.
+    # NotFound propagates so misses aren't cached.
+    return _BUCKET.blob(blob_path).download_as_bytes()
+
+
+def _fetch_blob_bytes(blob_path: str) -> bytes | None:
+    """Download a blob from STAMP_BUCKET, served from memory when the container is warm."""
+    try:
+        return _fetch_blob_bytes_cached(blob_path)
+    except gcs_exc.NotFound:
+        return None
 
 
 # ----------------------------------------------------------------------
@@ -90,98 +128,126 @@ def _random_filename(prefix: str = "image") -> str:
 # ----------------------------------------------------------------------
 
 def _random_transform(img: Image.Image) -> Image.Image:
+    """
+    Randomly scale and rotate (counter-clockwise, expanded to fit) in a single
+    affine resample instead of a resize followed by a rotate.
+    """
     scale = random.uniform(MIN_SCALE, MAX_SCALE)
-    new_w = max(1, int(img.width * scale))
-    new_h = max(1, int(img.height * scale))
-    img_scaled = img.resize((new_w, new_h), Image.LANCZOS)
-
     angle = random.uniform(-MAX_ROTATION_DEG, MAX_ROTATION_DEG)
-    return img_scaled.rotate(angle, resample=Image.BICUBIC, expand=True)
+
+    w, h = img.size
+    rad = math.radians(angle)
+    cos_a, sin_a = math.cos(rad), math.sin(rad)
+    out_w = max(1, math.ceil(scale * (abs(cos_a) * w + abs(sin_a) * h)))
+    out_h = max(1, math.ceil(scale * (abs(sin_a) * w + abs(cos_a) * h)))
+
+    # Image.transform wants the inverse map (output pixel -> input pixel):
+    # input = R(-angle) / scale @ (output - out_centre) + in_centre
+    a, b = cos_a / scale, -sin_a / scale
+    d, e = sin_a / scale, cos_a / scale
+    c = w / 2 - (a * out_w / 2 + b * out_h / 2)
+    f = h / 2 - (d * out_w / 2 + e * out_h / 2)
+
+    return img.transform(
+        (out_w, out_h), Image.AFFINE, (a, b, c, d, e, f), resample=Image.BICUBIC
+    )
 
 
-def _boxes_overlap(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> bool:
-    ax, ay, aw, ah = a
-    bx, by, bw, bh = b
-    return not (ax + aw <= bx or bx + bw <= ax or ay + ah <= by or by + bh <= ay)
+def _collisions(
+    placed_np: np.ndarray,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    w: int,
+    h: int,
+) -> np.ndarray:
+    """For each candidate (xs[i], ys[i], w, h), whether it overlaps any placed x/y/w/h box."""
+    px, py, pw, ph = placed_np.T
+    xs = xs[:, None]
+    ys = ys[:, None]
+    overlaps = ~((px + pw <= xs) | (xs + w <= px) | (py + ph <= ys) | (ys + h <= py))
+    return overlaps.any(axis=1)
 
 
 def _choose_position(
     img_w: int,
     img_h: int,
-    placed_boxes: List[Tuple[int, int, int, int]],
+    placed_np: np.ndarray,
 ) -> Tuple[int, int]:
     retries = OVERLAP_RETRIES if AVOID_OVERLAP else 1
+    high = [max(0, CANVAS_WIDTH - img_w) + 1, max(0, CANVAS_HEIGHT - img_h) + 1]
+    candidates = _rng.integers(0, high, size=(retries, 2))
 
-    for _ in range(retries):
-        x = random.randint(0, max(0, CANVAS_WIDTH - img_w))
-        y = random.randint(0, max(0, CANVAS_HEIGHT - img_h))
-        candidate = (x, y, img_w, img_h)
+    if not AVOID_OVERLAP or len(placed_np) == 0:
+        return int(candidates[0, 0]), int(candidates[0, 1])
 
-        if not AVOID_OVERLAP or not any(_boxes_overlap(candidate, b) for b in placed_boxes):
-            return x, y
+    collides = _collisions(placed_np, candidates[:, 0], candidates[:, 1], img_w, img_h)
 
-    # Fallback: accept overlap
-    x = random.randint(0, max(0, CANVAS_WIDTH - img_w))
-    y = random.randint(0, max(0, CANVAS_HEIGHT - img_h))
-    return x, y
+    # First free candidate; argmax is 0 if all collide (fallback: accept overlap)
+    idx = int(np.argmax(~collides))
+    return int(candidates[idx, 0]), int(candidates[idx, 1])
 
 
 def _load_stamp_from_gcs(code: str) -> Image.Image | None:
     """Load au-arrival.png etc from gs://bucket/passportStamps"""
-    bucket_name = _require_bucket()
-    bucket = get_storage_client().bucket(bucket_name)
-
     # Matches au-arrival.png, bt-arrival.png, etc.
     filename = f"{code.lower()}-arrival.png"
     blob_path = f"{STAMPS_PREFIX.rstrip('/')}/{filename}"
-    blob = bucket.blob(blob_path)
 
-    if not blob.exists():
+    img_bytes = _fetch_blob_bytes(blob_path)
+    if img_bytes is None:
         return None
 
-    img_bytes = blob.download_as_bytes()
-    img = Image.open(io.BytesIO(img_bytes)).convert("RGBA")
-    return ImageOps.contain(img, (img.width, img.height))
+    return Image.open(io.BytesIO(img_bytes)).convert("RGBA")
 
 
 def _save_canvas_to_gcs(canvas: Image.Image, filename: str, output_prefix: str) -> str:
-    bucket_name = _require_bucket()
-    bucket = get_storage_client().bucket(bucket_name)
-
     blob_path = f"{output_prefix.rstrip('/')}/{filename}"
-    blob = bucket.blob(blob_path)
+    blob = _BUCKET.blob(blob_path)
 
     buf = io.BytesIO()
-    canvas.save(buf, format="PNG")
-    buf.seek(0)
-    blob.upload_from_file(buf, content_type="image/png")
+    if OUTPUT_FORMAT == "webp":
+        canvas.save(buf, format="WEBP", quality=90, method=4)
+        content_type = "image/webp"
+    else:
+        # zlib level 1: far less CPU than the default 6 for slightly larger files
+        canvas.save(buf, format="PNG", compress_level=1, optimize=False)
+        content_type = "image/png"
+    # Single-shot multipart upload; upload_from_file would start a resumable session
+    blob.upload_from_string(buf.getvalue(), content_type=content_type)
 
-    return f"gs://{bucket_name}/{blob_path}"
+    return f"gs://{STAMP_BUCKET}/{blob_path}"
 
 
 def compose_passport_stamps(codes: List[str]) -> dict:
-    codes = [c.lower() for c in codes if c]
+    # Normalise, drop blanks and de-duplicate (keeping order) in one pass
+    codes = list(dict.fromkeys(s for c in codes if (s := c.strip().lower())))
 
     if not codes:
         raise ValueError("No country codes provided.")
 
     canvas = Image.new("RGBA", (CANVAS_WIDTH, CANVAS_HEIGHT), (0, 0, 0, 0))
-    placed_boxes: List[Tuple[int, int, int, int]] = []
+    placed_np = np.empty((0, 4), dtype=np.int32)
     placed: List[str] = []
     missing: List[str] = []
 
-    for code in codes:
-        stamp = _load_stamp_from_gcs(code)
+    with ThreadPoolExecutor(max_workers=min(DOWNLOAD_WORKERS, len(codes))) as pool:
+        stamps = list(pool.map(_load_stamp_from_gcs, codes))
 
+    # Transform + placement stay on this thread so placement order is stable
+    for code, stamp in zip(codes, stamps):
         if stamp is None:
             missing.append(code)
             continue
 
         transformed = _random_transform(stamp)
-        x, y = _choose_position(transformed.width, transformed.height, placed_boxes)
+        x, y = _choose_position(transformed.width, transformed.height, placed_np)
 
+        # Pillow's integer "over" only touches the stamp's box and beats a
+        # NumPy blend, which has to widen the region into temporaries
         canvas.alpha_composite(transformed, dest=(x, y))
-        placed_boxes.append((x, y, transformed.width, transformed.height))
+        placed_np = np.vstack(
+            [placed_np, np.array([x, y, transformed.width, transformed.height], dtype=np.int32)]
+        )
         placed.append(code)
 
     if not placed:
@@ -215,6 +281,10 @@ def hex_to_rgba(col: str) -> Tuple[int, int, int, int] | None:
     return (255, 255, 255, 255)
 
 
+def _has_alpha(img: Image.Image) -> bool:
+    return img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+
+
 def make_uniform_tile_from_bytes(
     img_bytes: bytes,
     box_h: int,
@@ -222,22 +292,33 @@ def make_uniform_tile_from_bytes(
     fit_mode: str = "pad",
 ) -> Image.Image:
     """
-    Returns an RGBA tile of size (box_w, box_h) where box_w = ratio * box_h.
+    Returns a tile of size (box_w, box_h) where box_w = ratio * box_h.
+
+    The tile is RGBA for "pad" (transparent gutters) and for sources with
+    alpha; opaque sources in "crop"/"stretch" stay RGB to save bandwidth.
     """
     box_w = int(round(ratio_w_over_h * box_h))
     box_h = int(box_h)
 
-    img = Image.open(io.BytesIO(img_bytes)).convert("RGBA")
+    img = Image.open(io.BytesIO(img_bytes))
+    if fit_mode == "pad" or _has_alpha(img):
+        img = img.convert("RGBA")
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
     w, h = img.size
 
     if fit_mode == "pad":
         scale = min(box_w / w, box_h / h)
         new_w = max(1, int(round(w * scale)))
         new_h = max(1, int(round(h * scale)))
-        img = img.resize((new_w, new_h), Image.LANCZOS)
+        if scale < 1:
+            # Shrink in place; thumbnail reduces by whole factors before resampling
+            img.thumbnail((new_w, new_h), Image.LANCZOS)
+        else:
+            img = img.resize((new_w, new_h), Image.LANCZOS)
         tile = Image.new("RGBA", (box_w, box_h), (0, 0, 0, 0))
-        x = (box_w - new_w) // 2
-        y = (box_h - new_h) // 2
+        x = (box_w - img.width) // 2
+        y = (box_h - img.height) // 2
         tile.alpha_composite(img, (x, y))
         return tile
 
@@ -264,17 +345,20 @@ def _load_flag_tile_from_gcs(
     """
     Load a flag PNG (code.png) from FLAGS_PREFIX and build a 1:2 tile.
     """
-    bucket_name = _require_bucket()
-    bucket = get_storage_client().bucket(bucket_name)
-
     flag_filename = f"{code.lower()}.png"
-    blob_path = f"{FLAGS_PREFIX.rstrip('/')}/{flag_filename}"
-    blob = bucket.blob(blob_path)
+    img_bytes = None
 
-    if not blob.exists():
+    # Decoding and downscaling a 1000px source dominates small tiles
+    if 2 * tile_height <= FLAGS_SMALL_WIDTH and flag_filename not in _small_flag_misses:
+        img_bytes = _fetch_blob_bytes(f"{FLAGS_PREFIX_SMALL.rstrip('/')}/{flag_filename}")
+        if img_bytes is None:
+            _small_flag_misses.add(flag_filename)
+
+    if img_bytes is None:
+        img_bytes = _fetch_blob_bytes(f"{FLAGS_PREFIX.rstrip('/')}/{flag_filename}")
+    if img_bytes is None:
         return None
 
-    img_bytes = blob.download_as_bytes()
     return make_uniform_tile_from_bytes(
         img_bytes, tile_height, ratio_w_over_h=2.0, fit_mode=fit_mode
     )
@@ -291,15 +375,20 @@ def build_flag_grid(
     """
     Build a grid of flags (1:2 ratio tiles) and upload to FLAGS_OUTPUT_PREFIX.
     """
-    codes = [c.strip().lower() for c in codes if c.strip()]
+    # Normalise, drop blanks and de-duplicate (keeping order) in one pass
+    codes = list(dict.fromkeys(s for c in codes if (s := c.strip().lower())))
     if not codes:
         raise ValueError("No country codes provided.")
 
     missing: List[str] = []
     tiles: List[Tuple[str, Image.Image]] = []
 
-    for code in codes:
-        tile = _load_flag_tile_from_gcs(code, tile_height, fit_mode)
+    with ThreadPoolExecutor(max_workers=min(DOWNLOAD_WORKERS, len(codes))) as pool:
+        loaded = list(
+            pool.map(lambda c: _load_flag_tile_from_gcs(c, tile_height, fit_mode), codes)
+        )
+
+    for code, tile in zip(codes, loaded):
         if tile is None:
             missing.append(code)
             continue
@@ -317,28 +406,35 @@ def build_flag_grid(
     canvas_w = cols * tile_w + (cols - 1) * gap
     canvas_h = rows * tile_h + (rows - 1) * gap
 
-    bg_rgba = hex_to_rgba(bg)
-    canvas = Image.new(
-        "RGBA",
-        (canvas_w, canvas_h),
-        (0, 0, 0, 0) if bg_rgba is None else bg_rgba,
-    )
+    positions = [
+        ((idx % cols) * (tile_w + gap), (idx // cols) * (tile_h + gap))
+        for idx in range(len(tiles))
+    ]
 
-    for idx, (_, tile) in enumerate(tiles):
-        r = idx // cols
-        c = idx % cols
-        x = c * (tile_w + gap)
-        y = r * (tile_h + gap)
-        canvas.alpha_composite(tile, (x, y))
+    bg_rgba = hex_to_rgba(bg)
+    if bg_rgba is None:
+        # Tiles never overlap, so compositing onto a fully transparent canvas
+        # is a plain copy: write them straight into the backing array.
+        arr = np.zeros((canvas_h, canvas_w, 4), dtype=np.uint8)
+        for (_, tile), (x, y) in zip(tiles, positions):
+            if tile.mode == "RGBA":
+                arr[y:y + tile_h, x:x + tile_w] = np.asarray(tile)
+            else:
+                arr[y:y + tile_h, x:x + tile_w, :3] = np.asarray(tile)
+                arr[y:y + tile_h, x:x + tile_w, 3] = 255
+        canvas = Image.frombuffer("RGBA", (canvas_w, canvas_h), arr, "raw", "RGBA", 0, 1)
+    else:
+        # Opaque background: build RGB from the start and paste, using the
+        # tile itself as mask only where it has transparency (pad gutters,
+        # flags with transparent areas). Opaque tiles are a straight copy.
+        canvas = Image.new("RGB", (canvas_w, canvas_h), bg_rgba[:3])
+        for (_, tile), (x, y) in zip(tiles, positions):
+            opaque = tile.mode != "RGBA" or tile.getextrema()[3][0] == 255
+            canvas.paste(tile, (x, y), None if opaque else tile)
 
     filename = _random_filename(prefix="flags")
 
-    # If background is transparent, keep RGBA. Otherwise, convert to RGB.
-    if bg_rgba is None:
-        gs_path = _save_canvas_to_gcs(canvas, filename, FLAGS_OUTPUT_PREFIX)
-    else:
-        rgb_canvas = canvas.convert("RGB")
-        gs_path = _save_canvas_to_gcs(rgb_canvas, filename, FLAGS_OUTPUT_PREFIX)
+    gs_path = _save_canvas_to_gcs(canvas, filename, FLAGS_OUTPUT_PREFIX)
 
     placed_codes = [code for code, _ in tiles]
 
@@ -350,6 +446,32 @@ def build_flag_grid(
     }
 
 
+# ----------------------------------------------------------------------
+# WARM-UP
+# ----------------------------------------------------------------------
+
+def _warm_up() -> None:
+    """
+    Exercise Pillow's resample/encode paths and open the GCS connection during
+    container init so the first request doesn't pay for it.
+    """
+    try:
+        img = Image.new("RGBA", (4, 4))
+        img.resize((2, 2), Image.LANCZOS)
+        img.transform((4, 4), Image.AFFINE, (1, 0, 0, 0, 1, 0), resample=Image.BICUBIC)
+        img.save(io.BytesIO(), format="PNG", compress_level=1)
+        # Short, unretried probe: it only has to open the connection pool
+        _BUCKET.exists(timeout=2, retry=None)
+    except Exception:
+        # Best effort only: a slow network or a service account without
+        # bucket metadata access must not fail container init. (Missing
+        # credentials or STAMP_BUCKET already fail import further up.)
+        pass
+
+
+_warm_up()
+
+
 # Re-export HTTP handlers defined in separate modules for deployment entrypoints.
 from .compose_passport_stamps_http import compose_passport_stamps_http  # noqa: E402,F401
 from .flag_grid_http import flag_grid_http  # noqa: E402,F401
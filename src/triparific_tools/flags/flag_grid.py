@@ -1,6 +1,21 @@
 #!/usr/bin/env python3
-import argparse, os, sys, math, datetime
+"""
+Build a grid of country flags, each scaled to a common height, and save it
+to /tmp as a PNG.
+
+Resizing is the bulk of the runtime. Install pillow-simd in place of Pillow
+(`pip uninstall pillow && pip install pillow-simd`) for SIMD LANCZOS kernels;
+no code changes are needed.
+"""
+import argparse, os, sys, math, datetime, hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image
+try:
+    from triparific_tools.imaging import has_alpha, list_files, save_png, warn_if_stock_pillow
+except ImportError:  # run as a plain script: put src/ on the path
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+    from triparific_tools.imaging import has_alpha, list_files, save_png, warn_if_stock_pillow
 
 def parse_args():
     p = argparse.ArgumentParser(description="Build a grid of country flags.")
@@ -13,32 +28,108 @@ def parse_args():
                    help="Target height for each flag while preserving aspect ratio (default: 250).")
     p.add_argument("--bg", default="#FFFFFF",
                    help="Background color, e.g. #FFFFFF or 'transparent'. Default white.")
+    p.add_argument("--compress-level", type=int, choices=range(10), default=1, metavar="0-9",
+                   help="PNG zlib level (default: 1, fast). Re-encode at 9 offline for publishable files.")
+    p.add_argument("--no-cache", action="store_true",
+                   help="Don't read or write scaled flags under ~/.cache/triparific/flags.")
     return p.parse_args()
 
 def load_and_scale(img_path, target_h):
-    img = Image.open(img_path).convert("RGBA")
+    img = Image.open(img_path)
+    # Let JPEG decode at 1/2, 1/4 or 1/8 scale while staying >= target_h; no-op for PNG
+    img.draft("RGB", (1, target_h))
+    # Most flags are opaque: keep those RGB so they paste as a plain copy
+    img = img.convert("RGBA" if has_alpha(img) else "RGB")
     w, h = img.size
-    if h != target_h:
+    if h > target_h:
+        # Shrink-only: thumbnail reduces by whole factors before LANCZOS; the
+        # huge width bound leaves height as the only constraint
+        img.thumbnail((10**9, target_h), Image.LANCZOS)
+    elif h < target_h:
         new_w = int(round(w * (target_h / h)))
         img = img.resize((new_w, target_h), Image.LANCZOS)
-    return img
+    # Carry (h, w, 3|4) uint8 arrays from here on; Pillow is only needed again to save
+    return np.asarray(img)
+
+CACHE_DIR = os.path.expanduser("~/.cache/triparific/flags")
+# Part of every cache key: bump when load_and_scale's output changes so stale
+# tiles stop matching. Old entries are never pruned; delete CACHE_DIR to reclaim.
+CACHE_VERSION = 1
+
+def cached_load_and_scale(img_path, target_h):
+    """
+    load_and_scale() with results cached as PNGs under CACHE_DIR, keyed on
+    source path, mtime and target height, so repeat runs skip decode + resize.
+    The cache is best-effort: if it can't be read or written the flag is
+    simply computed.
+    """
+    key = hashlib.sha1(f"scale:v{CACHE_VERSION}:{img_path}:{os.path.getmtime(img_path)}:{target_h}".encode()).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{key}.png")
+    try:
+        with Image.open(cache_path) as img:
+            return np.asarray(img)
+    except OSError:
+        pass
+
+    arr = load_and_scale(img_path, target_h)
+    # Write then rename so concurrent workers never read a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.{id(arr)}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        Image.fromarray(arr).save(tmp_path, format="PNG", compress_level=1, optimize=False)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return arr
+
+def blit(canvas_np, arr, x, y):
+    """
+    Write an (h, w, 3|4) uint8 flag into the canvas array at (x, y). Flags never
+    overlap, so this is a plain copy except for flags with alpha on an opaque
+    (RGB) canvas, which are blended over the background.
+    """
+    h, w = arr.shape[:2]
+    dst = canvas_np[y:y+h, x:x+w]
+    if arr.shape[2] == 3:
+        dst[..., :3] = arr
+        if dst.shape[2] == 4:
+            dst[..., 3] = 255
+    elif dst.shape[2] == 4:
+        dst[...] = arr
+    else:
+        a = arr[..., 3:4].astype(np.uint32)
+        blended = arr[..., :3] * a + dst * (255 - a)
+        dst[...] = ((blended + 127) // 255).astype(np.uint8)
 
 def main():
     args = parse_args()
+    warn_if_stock_pillow()
     codes = [c.strip().lower() for c in args.codes if c.strip()]
     if not codes:
         print("No country codes provided.", file=sys.stderr); sys.exit(1)
 
     # Resolve files (expecting filenames like 'au.png', 'cl.png', etc.)
+    available = list_files(args.src_root)
+
+    # Decode + resize release the GIL, so load flags on a thread pool
+    load = load_and_scale if args.no_cache else cached_load_and_scale
     missing = []
     images = []
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futs = {}
+        for code in codes:
+            if f"{code}.png" in available:
+                path = os.path.join(args.src_root, f"{code}.png")
+                futs[code] = ex.submit(load, path, args.scale_height)
     for code in codes:
-        path = os.path.join(args.src_root, f"{code}.png")
-        if not os.path.isfile(path):
+        if code not in futs:
             missing.append(code)
             continue
         try:
-            images.append((code, load_and_scale(path, args.scale_height)))
+            images.append((code, futs[code].result()))
         except Exception as e:
             missing.append(f"{code} (error: {e})")
 
@@ -60,17 +151,18 @@ def main():
     row_heights = []
     for r in range(rows):
         row_imgs = images[r*cols:(r+1)*cols]
-        row_w = sum(im.size[0] for _, im in row_imgs) + gap * (len(row_imgs) - 1 if len(row_imgs) > 1 else 0)
-        row_h = max(im.size[1] for _, im in row_imgs)
+        row_w = sum(arr.shape[1] for _, arr in row_imgs) + gap * (len(row_imgs) - 1 if len(row_imgs) > 1 else 0)
+        row_h = max(arr.shape[0] for _, arr in row_imgs)
         row_widths.append(row_w)
         row_heights.append(row_h)
 
     canvas_w = max(row_widths)
     canvas_h = sum(row_heights) + gap * (rows - 1 if rows > 1 else 0)
 
-    # Background
+    # Background: a transparent RGBA buffer, or an RGB one filled with the
+    # colour so flags need no per-pixel blend or final convert
     if args.bg.lower() == "transparent":
-        canvas = Image.new("RGBA", (canvas_w, canvas_h), (0, 0, 0, 0))
+        canvas_np = np.zeros((canvas_h, canvas_w, 4), dtype=np.uint8)
     else:
         # Convert hex to RGB
         col = args.bg
@@ -82,7 +174,7 @@ def main():
         else:
             # Fallback to white if parsing fails
             bg = (255, 255, 255, 255)
-        canvas = Image.new("RGBA", (canvas_w, canvas_h), bg)
+        canvas_np = np.full((canvas_h, canvas_w, 3), bg[:3], dtype=np.uint8)
 
     # Paste images
     y = 0
@@ -91,20 +183,18 @@ def main():
         row_h = row_heights[r]
         # left-align; could center by computing leftover = canvas_w - row_widths[r]
         x = 0
-        for code, im in row_imgs:
-            # vertically top-aligned; to center: y + (row_h - im.height)//2
-            canvas.alpha_composite(im, (x, y))
-            x += im.size[0] + gap
+        for code, arr in row_imgs:
+            # vertically top-aligned; to center: y + (row_h - arr.shape[0])//2
+            blit(canvas_np, arr, x, y)
+            x += arr.shape[1] + gap
         y += row_h + (gap if r < rows - 1 else 0)
 
+    canvas = Image.fromarray(canvas_np)
+
     # Save to /tmp with timestamp
     ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     out_path = f"/tmp/flags_grid_{ts}.png"
-    # Convert to RGB if background isn’t transparent (smaller file)
-    if args.bg.lower() == "transparent":
-        canvas.save(out_path, format="PNG")
-    else:
-        canvas.convert("RGB").save(out_path, format="PNG")
+    save_png(canvas, out_path, args.compress_level)
 
     print(out_path)
 
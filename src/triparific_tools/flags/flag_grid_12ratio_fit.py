@@ -1,6 +1,20 @@
 #!/usr/bin/env python3
-import argparse, os, sys, math, datetime
+"""
+Build a uniform 1:2 (h:w) grid of country flags and save it to /tmp as a PNG.
+
+Most of the time goes into LANCZOS-resizing the 1000px sources down to tile
+size. pillow-simd is a drop-in Pillow replacement with vectorised resampling:
+`pip uninstall pillow && pip install pillow-simd`.
+"""
+import argparse, os, sys, math, datetime, hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image
+try:
+    from triparific_tools.imaging import has_alpha, list_files, save_png, warn_if_stock_pillow
+except ImportError:  # run as a plain script: put src/ on the path
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+    from triparific_tools.imaging import has_alpha, list_files, save_png, warn_if_stock_pillow
 
 def parse_args():
     p = argparse.ArgumentParser(description="Build a uniform 1:2 (h:w) grid of country flags.")
@@ -15,6 +29,10 @@ def parse_args():
                    help="Background color for the whole grid. 'transparent' (default) or #RRGGBB.")
     p.add_argument("--fit-mode", choices=["pad", "crop"], default="pad",
                    help="How to fit flags into the 1:2 tile. 'pad' preserves all content; 'crop' fills then center-crops.")
+    p.add_argument("--compress-level", type=int, choices=range(10), default=1, metavar="0-9",
+                   help="PNG zlib level (default: 1, fast). Re-encode at 9 offline for publishable files.")
+    p.add_argument("--no-cache", action="store_true",
+                   help="Don't read or write tiles under ~/.cache/triparific/flags.")
     return p.parse_args()
 
 def hex_to_rgba(col):
@@ -27,17 +45,31 @@ def hex_to_rgba(col):
         return (r, g, b, 255)
     return (255, 255, 255, 255)
 
-def make_uniform_tile(img_path, box_h, ratio_w_over_h=2.0, fit_mode="pad"):
+def make_uniform_tile(img_path, box_h, ratio_w_over_h=2.0, fit_mode="pad", bg_rgba=None):
     """
-    Returns an RGBA tile of size (box_w, box_h) where box_w = ratio * box_h.
+    Returns a tile of size (box_w, box_h) where box_w = ratio * box_h.
     fit_mode:
-      - 'pad': scale to fit entirely inside and center with transparent padding.
+      - 'pad': scale to fit entirely inside and center with padding.
       - 'crop': scale to fill, then center-crop to exact size.
+    bg_rgba: None pads with transparency, which needs an RGBA tile; an opaque
+    colour pads with that colour into an RGB tile instead.
     """
     box_w = int(round(ratio_w_over_h * box_h))
     box_h = int(box_h)
 
-    img = Image.open(img_path).convert("RGBA")
+    img = Image.open(img_path)
+    # Let JPEG decode at a reduced scale that still covers the target; no-op
+    # for PNG. Image.open has only parsed the header, so the size is free here.
+    if fit_mode == "pad":
+        w, h = img.size
+        fit = min(box_w / w, box_h / h)
+        # 2x headroom leaves the anti-aliasing to the LANCZOS pass below
+        img.draft("RGB", (max(1, int(w * fit)) * 2, max(1, int(h * fit)) * 2))
+    else:
+        img.draft("RGB", (box_w, box_h))
+    # Transparent padding needs alpha for the gutters; opaque flags otherwise stay RGB
+    pad_rgba = fit_mode == "pad" and bg_rgba is None
+    img = img.convert("RGBA" if pad_rgba or has_alpha(img) else "RGB")
     w, h = img.size
 
     if fit_mode == "pad":
@@ -45,11 +77,18 @@ def make_uniform_tile(img_path, box_h, ratio_w_over_h=2.0, fit_mode="pad"):
         scale = min(box_w / w, box_h / h)
         new_w = max(1, int(round(w * scale)))
         new_h = max(1, int(round(h * scale)))
-        img = img.resize((new_w, new_h), Image.LANCZOS)
-        tile = Image.new("RGBA", (box_w, box_h), (0, 0, 0, 0))
-        x = (box_w - new_w) // 2
-        y = (box_h - new_h) // 2
-        tile.alpha_composite(img, (x, y))
+        if scale < 1:
+            img.thumbnail((box_w, box_h), Image.LANCZOS)
+        else:
+            img = img.resize((new_w, new_h), Image.LANCZOS)
+        x = (box_w - img.width) // 2
+        y = (box_h - img.height) // 2
+        if pad_rgba:
+            tile = Image.new("RGBA", (box_w, box_h), (0, 0, 0, 0))
+            tile.alpha_composite(img, (x, y))
+        else:
+            tile = Image.new("RGB", (box_w, box_h), bg_rgba[:3])
+            tile.paste(img, (x, y), img if img.mode == "RGBA" else None)
         return tile
 
     # fit_mode == "crop": scale to FILL, then crop center
@@ -66,20 +105,80 @@ def make_uniform_tile(img_path, box_h, ratio_w_over_h=2.0, fit_mode="pad"):
     cropped = img.crop((left, top, right, bottom))
     return cropped
 
+CACHE_DIR = os.path.expanduser("~/.cache/triparific/flags")
+# Part of every cache key: bump when make_uniform_tile's output changes so stale
+# tiles stop matching. Old entries are never pruned; delete CACHE_DIR to reclaim.
+CACHE_VERSION = 1
+
+def cached_make_uniform_tile(img_path, box_h, ratio_w_over_h=2.0, fit_mode="pad", bg_rgba=None):
+    """
+    Disk-cached make_uniform_tile(). A source file's mtime is part of the key,
+    so editing a flag invalidates its tiles. Best-effort: if the cache can't
+    be read or written the tile is simply computed.
+    """
+    key = hashlib.sha1(f"tile:v{CACHE_VERSION}:{img_path}:{os.path.getmtime(img_path)}:{box_h}:{ratio_w_over_h}:{fit_mode}:{bg_rgba}".encode()).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{key}.png")
+    try:
+        img = Image.open(cache_path)
+        img.load()
+        return img
+    except OSError:
+        pass
+
+    img = make_uniform_tile(img_path, box_h, ratio_w_over_h, fit_mode, bg_rgba)
+    # Write then rename so concurrent workers never read a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.{id(img)}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        img.save(tmp_path, format="PNG", compress_level=1, optimize=False)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return img
+
+def blit(canvas, tile, x, y):
+    """
+    Write an (h, w, 3|4) uint8 tile into the canvas array at (x, y). Tiles never
+    overlap, so this is a slice copy except for an RGBA tile on an RGB canvas
+    (crop-mode flags with transparency), which is blended over the background.
+    """
+    h, w = tile.shape[:2]
+    dst = canvas[y:y+h, x:x+w]
+    if tile.shape[2] == dst.shape[2]:
+        dst[...] = tile
+    else:
+        a = tile[:, :, 3:4].astype(np.uint32)
+        dst[...] = (tile[:, :, :3] * a + dst * (255 - a) + 127) // 255
+
 def main():
     args = parse_args()
+    warn_if_stock_pillow()
     codes = [c.strip().lower() for c in args.codes if c.strip()]
     if not codes:
         print("No country codes provided.", file=sys.stderr); sys.exit(1)
 
+    available = list_files(args.src_root)
+
+    bg_rgba = hex_to_rgba(args.bg)
+
+    # Tiles are independent and Pillow releases the GIL while decoding/resizing
+    load = make_uniform_tile if args.no_cache else cached_make_uniform_tile
     missing, tiles = [], []
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futs = {}
+        for code in codes:
+            if f"{code}.png" in available:
+                path = os.path.join(args.src_root, f"{code}.png")
+                futs[code] = ex.submit(load, path, args.tile_height, ratio_w_over_h=2.0,
+                                       fit_mode=args.fit_mode, bg_rgba=bg_rgba)
     for code in codes:
-        path = os.path.join(args.src_root, f"{code}.png")
-        if not os.path.isfile(path):
+        if code not in futs:
             missing.append(code); continue
         try:
-            tile = make_uniform_tile(path, args.tile_height, ratio_w_over_h=2.0, fit_mode=args.fit_mode)
-            tiles.append((code, tile))
+            tiles.append((code, futs[code].result()))
         except Exception as e:
             missing.append(f"{code} (error: {e})")
 
@@ -101,8 +200,12 @@ def main():
     canvas_w = cols * tile_w + (cols - 1) * gap
     canvas_h = rows * tile_h + (rows - 1) * gap
 
-    bg_rgba = hex_to_rgba(args.bg)
-    canvas = Image.new("RGBA", (canvas_w, canvas_h), (0, 0, 0, 0) if bg_rgba is None else bg_rgba)
+    # Opaque background: RGB canvas, so tiles blit without a final convert
+    if bg_rgba is None:
+        canvas = np.zeros((canvas_h, canvas_w, 4), dtype=np.uint8)
+    else:
+        canvas = np.empty((canvas_h, canvas_w, 3), dtype=np.uint8)
+        canvas[...] = bg_rgba[:3]
 
     # Paste tiles
     for idx, (_, tile) in enumerate(tiles):
@@ -110,15 +213,16 @@ def main():
         c = idx % cols
         x = c * (tile_w + gap)
         y = r * (tile_h + gap)
-        canvas.alpha_composite(tile, (x, y))
+        # Tiles don't overlap: alpha_over onto the zeroed transparent canvas is a
+        # plain RGBA copy. On RGB, pad tiles are already RGB (see make_uniform_tile)
+        if bg_rgba is None and tile.mode != "RGBA":
+            tile = tile.convert("RGBA")
+        blit(canvas, np.asarray(tile), x, y)
 
     ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     out_path = f"/tmp/flags_grid_{ts}.png"
 
-    if bg_rgba is None:
-        canvas.save(out_path, format="PNG")
-    else:
-        canvas.convert("RGB").save(out_path, format="PNG")
+    save_png(Image.fromarray(canvas), out_path, args.compress_level)
 
     print(out_path)
 
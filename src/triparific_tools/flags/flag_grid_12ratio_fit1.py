@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 import argparse, os, sys, math, datetime
 from PIL import Image
+try:
+    from triparific_tools.imaging import list_files, save_png
+except ImportError:  # run as a plain script: put src/ on the path
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+    from triparific_tools.imaging import list_files, save_png
 
 def parse_args():
     p = argparse.ArgumentParser(description="Build a uniform 1:2 (h:w) grid of country flags.")
@@ -15,6 +20,8 @@ def parse_args():
                    help="Background color for the whole grid. 'transparent' (default) or #RRGGBB.")
     p.add_argument("--fit-mode", choices=["pad", "crop", "stretch"], default="pad",
                    help="pad: fit inside with padding; crop: fill then center-crop; stretch: resize to exact 1:2 ratio.")
+    p.add_argument("--compress-level", type=int, choices=range(10), default=1, metavar="0-9",
+                   help="PNG zlib level (default: 1, fast). Re-encode at 9 offline for publishable files.")
     return p.parse_args()
 
 def hex_to_rgba(col):
@@ -73,11 +80,12 @@ def main():
     if not codes:
         print("No country codes provided.", file=sys.stderr); sys.exit(1)
 
+    available = list_files(args.src_root)
     missing, tiles = [], []
     for code in codes:
-        path = os.path.join(args.src_root, f"{code}.png")
-        if not os.path.isfile(path):
+        if f"{code}.png" not in available:
             missing.append(code); continue
+        path = os.path.join(args.src_root, f"{code}.png")
         try:
             tile = make_uniform_tile(path, args.tile_height, ratio_w_over_h=2.0, fit_mode=args.fit_mode)
             tiles.append((code, tile))
@@ -101,22 +109,23 @@ def main():
     canvas_h = rows * tile_h + (rows - 1) * gap
 
     bg_rgba = hex_to_rgba(args.bg)
-    canvas = Image.new("RGBA", (canvas_w, canvas_h), (0, 0, 0, 0) if bg_rgba is None else bg_rgba)
+    if bg_rgba is None:
+        canvas = Image.new("RGBA", (canvas_w, canvas_h), (0, 0, 0, 0))
+    else:
+        canvas = Image.new("RGB", (canvas_w, canvas_h), bg_rgba[:3])
 
     for idx, (_, tile) in enumerate(tiles):
         r = idx // cols
         c = idx % cols
         x = c * (tile_w + gap)
         y = r * (tile_h + gap)
-        canvas.alpha_composite(tile, (x, y))
+        # Non-overlapping tiles: plain paste onto transparent, masked onto RGB
+        canvas.paste(tile, (x, y), tile if canvas.mode == "RGB" else None)
 
     ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     out_path = f"/tmp/flags_grid_{ts}.png"
 
-    if bg_rgba is None:
-        canvas.save(out_path, format="PNG")
-    else:
-        canvas.convert("RGB").save(out_path, format="PNG")
+    save_png(canvas, out_path, args.compress_level)
 
     print(out_path)
 
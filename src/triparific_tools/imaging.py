@@ -0,0 +1,45 @@
+"""
+Helpers shared by the flag grid and passport stamp scripts.
+"""
+import io
+import os
+import sys
+
+import PIL
+
+
+def has_alpha(img):
+    return img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+
+
+def list_files(root):
+    """
+    Names of the regular files in root, from a single directory read rather
+    than a stat() per lookup. An unreadable or missing root gives an empty
+    set, so callers report every code as missing.
+    """
+    try:
+        with os.scandir(root) as it:
+            return {e.name for e in it if e.is_file()}
+    except OSError:
+        return set()
+
+
+def warn_if_stock_pillow():
+    # pillow-simd versions carry a ".postN" suffix
+    if ".post" not in PIL.__version__:
+        print(f"Note: stock Pillow {PIL.__version__} detected; pillow-simd resizes several times faster.",
+              file=sys.stderr)
+
+
+def save_png(img, out_path, compress_level):
+    """Encode to memory first, then write the file with raw os.write calls."""
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=compress_level, optimize=False)
+    data = buf.getbuffer()
+    fd = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
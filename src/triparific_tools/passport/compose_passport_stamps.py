@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
+import math
 import os
 import sys
+import time
 import random
-import string
-from datetime import datetime
-from typing import List
-from PIL import Image, ImageOps
+import secrets
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+import numpy as np
+from PIL import Image
+
+try:
+    from triparific_tools.imaging import list_files, save_png
+except ImportError:  # run as a plain script: put src/ on the path
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+    from triparific_tools.imaging import list_files, save_png
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; fall back to Pillow's resamplers
+    njit = None
 
 # === Configuration ===
 STAMPS_DIR = "/Users/adglad/triparific/stamps/arrival/"
@@ -17,43 +32,168 @@ MAX_SCALE = 1.2
 MAX_ROTATION_DEG = 25
 AVOID_OVERLAP = True
 OVERLAP_RETRIES = 15
+# Fast zlib level for the temp output; re-encode at 9 offline if publishing
+PNG_COMPRESS_LEVEL = 1
 
 
 # === Helpers ===
 def _random_filename(prefix: str = "stamps") -> str:
-    ts = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
-    rand = "".join(random.choices(string.ascii_lowercase + string.digits, k=6))
-    return f"{prefix}_{ts}_{rand}.png"
+    return f"{prefix}_{time.time_ns()}_{secrets.token_hex(3)}.png"
+
+
+if njit is not None:
+    # nogil rather than parallel=True: stamps are already transformed on a
+    # thread pool, and numba's default threading layer isn't re-entrant
+    @njit(nogil=True, cache=True)
+    def _fused_scale_rotate(src, out, cos_a, sin_a, scale):
+        """
+        Scale + rotate src (H x W x 4 uint8) about its centre into out in one
+        pass, mapping each output pixel back to the source. The tent filter
+        widens by 1/scale when shrinking so downscales don't alias, and colour
+        is weighted by alpha (premultiplied) so transparent black doesn't
+        bleed into the edges.
+        """
+        sh, sw = src.shape[0], src.shape[1]
+        oh, ow = out.shape[0], out.shape[1]
+        inv = 1.0 / scale
+        support = max(1.0, inv)
+        for oy in range(oh):
+            dy = oy + 0.5 - oh / 2.0
+            for ox in range(ow):
+                dx = ox + 0.5 - ow / 2.0
+                sx = (cos_a * dx - sin_a * dy) * inv + sw / 2.0 - 0.5
+                sy = (sin_a * dx + cos_a * dy) * inv + sh / 2.0 - 0.5
+                y_lo = int(math.floor(sy - support)) + 1
+                y_hi = int(math.ceil(sy + support))
+                x_lo = int(math.floor(sx - support)) + 1
+                x_hi = int(math.ceil(sx + support))
+                wsum = 0.0
+                acc_a = 0.0
+                acc_r = 0.0
+                acc_g = 0.0
+                acc_b = 0.0
+                for yy in range(y_lo, y_hi):
+                    wy = 1.0 - abs(yy - sy) / support
+                    if wy <= 0.0:
+                        continue
+                    for xx in range(x_lo, x_hi):
+                        wx = 1.0 - abs(xx - sx) / support
+                        if wx <= 0.0:
+                            continue
+                        w = wx * wy
+                        # Outside the source counts as transparent
+                        wsum += w
+                        if yy < 0 or yy >= sh or xx < 0 or xx >= sw:
+                            continue
+                        wa = w * src[yy, xx, 3]
+                        if wa == 0.0:
+                            continue
+                        acc_a += wa
+                        acc_r += wa * src[yy, xx, 0]
+                        acc_g += wa * src[yy, xx, 1]
+                        acc_b += wa * src[yy, xx, 2]
+                if acc_a == 0.0:
+                    continue
+                out[oy, ox, 0] = min(255, int(acc_r / acc_a + 0.5))
+                out[oy, ox, 1] = min(255, int(acc_g / acc_a + 0.5))
+                out[oy, ox, 2] = min(255, int(acc_b / acc_a + 0.5))
+                out[oy, ox, 3] = min(255, int(acc_a / wsum + 0.5))
+
+if njit is not None:
+    @njit(nogil=True, cache=True)
+    def _alpha_over(dst, src, x, y):
+        """Straight-alpha "over" of RGBA src onto RGBA dst at (x, y), in place, clipped."""
+        h = min(src.shape[0], dst.shape[0] - y)
+        w = min(src.shape[1], dst.shape[1] - x)
+        for i in range(h):
+            for j in range(w):
+                sa = src[i, j, 3]
+                if sa == 0:
+                    continue
+                if sa == 255:
+                    for c in range(4):
+                        dst[y + i, x + j, c] = src[i, j, c]
+                    continue
+                sa_f = sa / 255.0
+                da_f = dst[y + i, x + j, 3] / 255.0 * (1.0 - sa_f)
+                out_a = sa_f + da_f
+                for c in range(3):
+                    v = (src[i, j, c] * sa_f + dst[y + i, x + j, c] * da_f) / out_a
+                    dst[y + i, x + j, c] = min(255, int(v + 0.5))
+                dst[y + i, x + j, 3] = min(255, int(out_a * 255.0 + 0.5))
 
 
 def _random_transform(img: Image.Image) -> Image.Image:
     scale = random.uniform(MIN_SCALE, MAX_SCALE)
-    new_w = max(1, int(img.width * scale))
-    new_h = max(1, int(img.height * scale))
-    img_scaled = img.resize((new_w, new_h), Image.LANCZOS)
-
     angle = random.uniform(-MAX_ROTATION_DEG, MAX_ROTATION_DEG)
-    img_rot = img_scaled.rotate(angle, resample=Image.BICUBIC, expand=True)
-    return img_rot
 
+    # Counter-clockwise like Image.rotate, expanded to the rotated bounds
+    rad = math.radians(angle)
+    cos_a, sin_a = math.cos(rad), math.sin(rad)
+    out_w = max(1, math.ceil(scale * (abs(cos_a) * img.width + abs(sin_a) * img.height)))
+    out_h = max(1, math.ceil(scale * (abs(sin_a) * img.width + abs(cos_a) * img.height)))
+
+    if njit is not None:
+        out = np.zeros((out_h, out_w, 4), dtype=np.uint8)
+        _fused_scale_rotate(np.asarray(img), out, cos_a, sin_a, scale)
+        return Image.fromarray(out)
+
+    # Single affine resample instead of resize + rotate. The matrix maps output
+    # pixels back to input ones. Image.transform has no LANCZOS, so BICUBIC.
+    a, b = cos_a / scale, -sin_a / scale
+    d, e = sin_a / scale, cos_a / scale
+    c = img.width / 2 - (a * out_w / 2 + b * out_h / 2)
+    f = img.height / 2 - (d * out_w / 2 + e * out_h / 2)
+    return img.transform((out_w, out_h), Image.AFFINE, (a, b, c, d, e, f), resample=Image.BICUBIC)
 
-def _boxes_overlap(a, b) -> bool:
-    ax, ay, aw, ah = a
-    bx, by, bw, bh = b
-    return not (ax + aw <= bx or bx + bw <= ax or ay + ah <= by or by + bh <= ay)
 
+class _GridIndex:
+    """
+    Uniform-grid spatial index over placed (x1, y1, x2, y2) boxes, so an
+    overlap query only tests boxes sharing a cell with the candidate.
+    """
 
-def _choose_position(img_w: int, img_h: int, placed_boxes: List[tuple]) -> tuple:
+    def __init__(self, cell: int = 200):
+        self.cell = cell
+        self.boxes = np.empty((0, 4), dtype=np.int32)
+        self.cells: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+
+    def _cells_for(self, x1: int, y1: int, x2: int, y2: int):
+        c = self.cell
+        for cx in range(x1 // c, (x2 - 1) // c + 1):
+            for cy in range(y1 // c, (y2 - 1) // c + 1):
+                yield (cx, cy)
+
+    def overlaps(self, x1: int, y1: int, x2: int, y2: int) -> bool:
+        near = {i for key in self._cells_for(x1, y1, x2, y2) for i in self.cells.get(key, ())}
+        if not near:
+            return False
+        b = self.boxes[list(near)]
+        no_overlap = (b[:, 2] <= x1) | (b[:, 0] >= x2) | (b[:, 3] <= y1) | (b[:, 1] >= y2)
+        return not no_overlap.all()
+
+    def insert(self, x1: int, y1: int, x2: int, y2: int) -> None:
+        idx = len(self.boxes)
+        self.boxes = np.vstack([self.boxes, np.array([[x1, y1, x2, y2]], dtype=np.int32)])
+        for key in self._cells_for(x1, y1, x2, y2):
+            self.cells[key].append(idx)
+
+
+def _choose_position(img_w: int, img_h: int, index: _GridIndex) -> tuple:
     for _ in range(OVERLAP_RETRIES if AVOID_OVERLAP else 1):
         x = random.randint(0, max(0, CANVAS_WIDTH - img_w))
         y = random.randint(0, max(0, CANVAS_HEIGHT - img_h))
-        candidate = (x, y, img_w, img_h)
-        if not AVOID_OVERLAP or not any(_boxes_overlap(candidate, b) for b in placed_boxes):
+        if not AVOID_OVERLAP or not index.overlaps(x, y, x + img_w, y + img_h):
             return (x, y)
     return (random.randint(0, max(0, CANVAS_WIDTH - img_w)),
             random.randint(0, max(0, CANVAS_HEIGHT - img_h)))
 
 
+def _load_and_transform(filepath: str) -> Image.Image:
+    stamp = Image.open(filepath).convert("RGBA")
+    return _random_transform(stamp)
+
+
 # === Main function ===
 def compose_passport_stamps_local(codes: List[str]) -> str:
     codes = [c.lower() for c in codes if c]
@@ -62,25 +202,42 @@ def compose_passport_stamps_local(codes: List[str]) -> str:
         sys.exit(1)
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    canvas = Image.new("RGBA", (CANVAS_WIDTH, CANVAS_HEIGHT), (0, 0, 0, 0))
-    placed_boxes = []
+    # The jitted _alpha_over blends straight into a NumPy canvas; without numba,
+    # Pillow's integer alpha_composite beats any NumPy blend
+    if njit is not None:
+        canvas_np = np.zeros((CANVAS_HEIGHT, CANVAS_WIDTH, 4), dtype=np.uint8)
+    else:
+        canvas = Image.new("RGBA", (CANVAS_WIDTH, CANVAS_HEIGHT), (0, 0, 0, 0))
+    index = _GridIndex()
     placed = []
     missing = []
 
-    for code in codes:
-        filename = f"{code}-arrival.png"
-        filepath = os.path.join(STAMPS_DIR, filename)
+    available = list_files(STAMPS_DIR)
+
+    # Open + transform each stamp on a thread pool; placement below stays
+    # sequential since it depends on the stamps already placed
+    # (one future per position, so a repeated code still gets its own transform)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futs = []
+        for code in codes:
+            filename = f"{code}-arrival.png"
+            if filename in available:
+                futs.append(ex.submit(_load_and_transform, os.path.join(STAMPS_DIR, filename)))
+            else:
+                futs.append(None)
 
-        if not os.path.exists(filepath):
+    for code, fut in zip(codes, futs):
+        if fut is None:
             missing.append(code)
             continue
 
-        stamp = Image.open(filepath).convert("RGBA")
-        stamp = ImageOps.contain(stamp, (stamp.width, stamp.height))
-        stamp_t = _random_transform(stamp)
-        x, y = _choose_position(stamp_t.width, stamp_t.height, placed_boxes)
-        canvas.alpha_composite(stamp_t, dest=(x, y))
-        placed_boxes.append((x, y, stamp_t.width, stamp_t.height))
+        stamp_t = fut.result()
+        x, y = _choose_position(stamp_t.width, stamp_t.height, index)
+        if njit is not None:
+            _alpha_over(canvas_np, np.asarray(stamp_t), x, y)
+        else:
+            canvas.alpha_composite(stamp_t, dest=(x, y))
+        index.insert(x, y, x + stamp_t.width, y + stamp_t.height)
         placed.append(code)
 
     if not placed:
@@ -89,7 +246,9 @@ def compose_passport_stamps_local(codes: List[str]) -> str:
 
     output_filename = _random_filename()
     output_path = os.path.join(OUTPUT_DIR, output_filename)
-    canvas.save(output_path, "PNG")
+    if njit is not None:
+        canvas = Image.fromarray(canvas_np)
+    save_png(canvas, output_path, PNG_COMPRESS_LEVEL)
 
     print("✅ Composite image created!")
     print(f"📄 Output: {output_path}")